@@ -0,0 +1,12 @@
+import asyncio
+import os
+import sys
+
+# opt-in: use uvloop for loops created from now on (uvicorn already picks it up by itself when installed)
+if sys.platform != "win32" and os.environ.get("OPAL_MONGO_UVLOOP", "false").lower() in ("1", "true", "yes"):
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -1,24 +1,178 @@
 """
 Simple fetch provider for MongoDB.
 """
-from typing import Optional, List
-
-from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
+import functools
+import os
+import random
+import threading
+from typing import Optional, List, Dict, Set, Tuple
+
+import bson
+from bson import json_util
+from cachetools import TLRUCache
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
 from pymongo.errors import OperationFailure
-from pydantic import BaseModel, Field
-from tenacity import wait, stop, retry_unless_exception_type
+from pydantic import BaseModel, Extra, Field, PrivateAttr
 
 from opal_common.fetcher.fetch_provider import BaseFetchProvider
 from opal_common.fetcher.events import FetcherConfig, FetchEvent
 from opal_common.logger import logger
 
+# options of the cached clients, each one is only passed when its variable is set, since it would override the uri
+_CLIENT_OPTIONS_ENV = {
+    # number of connections each cached client keeps open, so that fetches don't pay the handshake
+    "OPAL_MONGO_MIN_POOL": ("minPoolSize", int),
+    "OPAL_MONGO_MAX_POOL": ("maxPoolSize", int),
+    # compressors are negotiated with the server, the first one supported by both is used
+    "OPAL_MONGO_COMPRESSORS": ("compressors", str),
+    "OPAL_MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+}
+MONGODB_CLIENT_OPTIONS = {
+    option: cast(os.environ[variable])
+    for variable, (option, cast) in _CLIENT_OPTIONS_ENV.items()
+    if variable in os.environ
+}
+
+# how long findOne queries on the same collection are buffered to be sent as a single query, 0 disables it
+MONGODB_COALESCE_WINDOW = float(os.environ.get("OPAL_MONGO_COALESCE_WINDOW_MS", "0")) / 1000
+
+# fetched documents are cached for this many seconds (unless overridden by the fetcher config), 0 disables it
+MONGODB_CACHE_TTL = float(os.environ.get("OPAL_MONGO_CACHE_TTL", "0"))
+MONGODB_CACHE_SIZE = int(os.environ.get("OPAL_MONGO_CACHE_SIZE", "1000"))
+
+# clients are shared across fetch events, one per uri and event loop (clients can't be shared between loops)
+_CLIENTS: Dict[Tuple[str, asyncio.AbstractEventLoop], AsyncMongoClient] = {}
+_CLIENTS_LOCK = threading.RLock()
+
+
+def get_client(uri: str) -> AsyncMongoClient:
+    """
+    Returns the cached client for the given uri on the running event loop, creating it if needed.
+    """
+    loop = asyncio.get_running_loop()
+
+    with _CLIENTS_LOCK:
+        # clients of closed loops can't be used (nor closed) anymore, don't keep them and their loops alive
+        for key in [key for key in _CLIENTS if key[1].is_closed()]:
+            del _CLIENTS[key]
+
+        client = _CLIENTS.get((uri, loop))
+        if client is None:
+            client = AsyncMongoClient(uri, **MONGODB_CLIENT_OPTIONS)
+            _CLIENTS[(uri, loop)] = client
+
+    return client
+
+
+def log_and_reraise(kind: str):
+    """
+    Logs any exception raised while executing the decorated query of the given kind, then re-raises it.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            logger.debug(f"{self.__class__.__name__} executing {kind}")
+
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception:
+                # a single record with the traceback, formatted by the logger
+                logger.exception("{} error executing {}", self.__class__.__name__, kind)
+
+                # pass along the original exception
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+class FetchCoalescer:
+    """
+    Buffers concurrent findOne queries against the same collection and sends them as a single `$in` find.
+
+    Only `_id` equality queries (i.e: `{"_id": "..."}`) can be coalesced, since they match at most one
+    document each and the returned documents can be matched back to the query that requested them exactly.
+    """
+
+    def __init__(self, window: float) -> None:
+        self._window = window
+        self._pending: Dict[Tuple[int, str], List[Tuple[dict, asyncio.Future]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def can_coalesce(query: Optional[dict]) -> bool:
+        """
+        Whether the query is a plain equality match on `_id`.
+        """
+        if not query or list(query) != ["_id"]:
+            return False
+
+        return not isinstance(query["_id"], (dict, list, bool))
+
+    async def find_one(self, collection: AsyncCollection, query: dict) -> Optional[dict]:
+        key = (id(collection.database.client), collection.full_name)
+        future = asyncio.get_running_loop().create_future()
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = []
+            task = asyncio.ensure_future(self._flush(key, collection))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        pending.append((query, future))
+
+        return await future
+
+    async def _flush(self, key: Tuple[int, str], collection: AsyncCollection) -> None:
+        await asyncio.sleep(self._window)
+
+        pending = self._pending.pop(key)
+
+        try:
+            # nothing to coalesce, run the query as it is
+            if len(pending) == 1:
+                query, future = pending[0]
+                document = await collection.find_one(query)
+                if not future.done():
+                    future.set_result(document)
+                return
+
+            ids = [query["_id"] for query, _ in pending]
+            documents = await collection.find({"_id": {"$in": ids}}).to_list(length=None)
+            documents_by_id = {document["_id"]: document for document in documents}
+
+            for query, future in pending:
+                if not future.done():
+                    future.set_result(documents_by_id.get(query["_id"]))
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+
+_COALESCER = FetchCoalescer(MONGODB_COALESCE_WINDOW)
+
+# cached entries are (ttl, encoded documents) tuples, so that each entry expires after its own ttl
+_RESULT_CACHE: TLRUCache = TLRUCache(
+    maxsize=MONGODB_CACHE_SIZE, ttu=lambda key, value, now: now + value[0]
+)
+
 
 class MongoDBFindOneParams(BaseModel):
     """
     Params needed to run a 'findOne' query against MongoDB.
     """
 
-    query: dict = Field(None, description="the query to run")
+    class Config:
+        allow_mutation = False
+        extra = Extra.ignore
+
+    query: Optional[dict] = Field(None, description="the query to run")
     projection: Optional[dict] = Field(None, description="the projection to run")
     options: Optional[dict] = Field(None, description="the options to pass to the findOne call, same args of PyMongo findOne")
 
@@ -28,7 +182,11 @@ class MongoDBFindParams(BaseModel):
     Params needed to run a 'find' query against MongoDB.
     """
 
-    query: dict = Field(None, description="the query to run")
+    class Config:
+        allow_mutation = False
+        extra = Extra.ignore
+
+    query: Optional[dict] = Field(None, description="the query to run")
     projection: Optional[dict] = Field(None, description="the projection to run")
     options: Optional[dict] = Field(None, description="the options to pass to the find call, same args of PyMongo find")
 
@@ -38,7 +196,11 @@ class MongoDBAggregateParams(BaseModel):
     Params needed to run an aggregation pipeline against MongoDB.
     """
 
-    pipeline: List[dict] = Field(None, description="the pipeline to run, an array of stages")
+    class Config:
+        allow_mutation = False
+        extra = Extra.ignore
+
+    pipeline: List[dict] = Field(..., description="the pipeline to run, an array of stages")
     options: Optional[dict] = Field(None, description="the options to pass to the aggregate call, same args of PyMongo aggregate")
 
 
@@ -47,9 +209,14 @@ class MongoDBTransformParams(BaseModel):
     Params that specify how the result from a MongoDB query should be transformed.
     """
 
-    first: Optional[bool] = Field(False, description="whether to return only the first document, used only by find and aggregate")
+    class Config:
+        allow_mutation = False
+        extra = Extra.ignore
+
+    first: bool = Field(False, description="whether to return only the first document, used only by find and aggregate")
     mapKey: Optional[str] = Field(None, description="transform the array of documents to an object, using the specified key as the object key, used only by find and aggregate")
-    merge: Optional[bool] = Field(False, description="merge the resulting array of documents into a single object, duplicated keys will be overwritten sequentially, used only by find and aggregate")
+    merge: bool = Field(False, description="merge the resulting array of documents into a single object, duplicated keys will be overwritten sequentially, used only by find and aggregate")
+    keepFields: Optional[List[str]] = Field(None, min_items=1, description="project the documents down to these fields on the server, the mapKey field is always kept, used only by find (when no projection is given) and aggregate")
 
 
 class MongoDBFetcherConfig(FetcherConfig):
@@ -57,6 +224,10 @@ class MongoDBFetcherConfig(FetcherConfig):
     Config for MongoDBFetchProvider, instance of `FetcherConfig`.
     """
 
+    class Config:
+        allow_mutation = False
+        extra = Extra.ignore
+
     fetcher: str = "MongoDBFetchProvider"
     database: Optional[str] = Field(
         None, description="the database to use"
@@ -80,7 +251,21 @@ class MongoDBFetcherConfig(FetcherConfig):
         None,
         description="transform the result of the query before updating the destination",
     )
+    cache_ttl: Optional[float] = Field(
+        None,
+        description="seconds to cache the fetched documents for, 0 disables the cache (defaults to OPAL_MONGO_CACHE_TTL)",
+    )
+
+    _cache_key: Optional[str] = PrivateAttr(None)
 
+    @property
+    def cache_key(self) -> str:
+        """
+        The canonical json of the config, computed once since the config can't change.
+        """
+        if self._cache_key is None:
+            self._cache_key = json_util.dumps(self.dict(exclude={"cache_ttl"}), sort_keys=True)
+        return self._cache_key
 
 
 class MongoDBFetchEvent(FetchEvent):
@@ -89,7 +274,7 @@ class MongoDBFetchEvent(FetchEvent):
     """
 
     fetcher: str = "MongoDBFetchProvider"
-    config: MongoDBFetcherConfig = None
+    config: Optional[MongoDBFetcherConfig] = None
 
 
 class MongoDBFetchProvider(BaseFetchProvider):
@@ -100,26 +285,30 @@ class MongoDBFetchProvider(BaseFetchProvider):
     transforming the results to json and dumping the results into the policy store.
     """
 
-    RETRY_CONFIG = {
-        "wait": wait.wait_random_exponential(),
-        "stop": stop.stop_after_attempt(10),
-        "retry": retry_unless_exception_type(
-            OperationFailure
-        ), # query error (i.e: invalid pipeline stage, etc)
-        "reraise": True,
-    }
+    RETRY_ATTEMPTS = 10
+    RETRY_INITIAL_WAIT = 0.1
+    RETRY_MAX_WAIT = 30
 
     def __init__(self, event: MongoDBFetchEvent) -> None:
         if event.config is None:
             # FIXME: where should collection be read from?
             event.config = MongoDBFetcherConfig(collection='')
         super().__init__(event)
-        self._connection: Optional[AsyncIOMotorClient] = None
+        self._connection: Optional[AsyncMongoClient] = None
+        # whether OPAL handed us the operator's retry config, to be honored instead of the default loop
+        self._custom_retry = False
         # TODO: implement readonly transaction.
         # self._transaction: Optional[Transaction] = None
 
     def parse_event(self, event: FetchEvent) -> MongoDBFetchEvent:
-        return MongoDBFetchEvent(**event.dict(exclude={"config"}), config=event.config)
+        # the event was already validated by OPAL, only our config needs to be parsed
+        config = event.config
+        if not isinstance(config, MongoDBFetcherConfig):
+            config = MongoDBFetcherConfig.parse_obj(config)
+
+        return MongoDBFetchEvent.construct(
+            **{key: value for key, value in event.__dict__.items() if key != "config"}, config=config
+        )
 
     async def __aenter__(self):
         self._event: MongoDBFetchEvent # type casting
@@ -128,8 +317,8 @@ class MongoDBFetchProvider(BaseFetchProvider):
 
         logger.debug(f"{self.__class__.__name__} connecting to database")
 
-        # connect to the MongoDB instance
-        self._connection: AsyncIOMotorClient = AsyncIOMotorClient(host=uri)
+        # reuse the connection pool to the MongoDB instance
+        self._connection: AsyncMongoClient = get_client(uri)
 
         # start a readonly transaction (we don't want OPAL client writing data due to security!)
         # TODO: implement readonly transaction.
@@ -144,10 +333,36 @@ class MongoDBFetchProvider(BaseFetchProvider):
         # if self._transaction is not None:
         #     await self._transaction.__aexit__(exc_type, exc_val, tb)
 
-        # Close the connection
-        if self._connection is not None:
-            # await self._connection.close()
-            self._connection.close()
+        # the connection is cached and shared with other fetch events, it lives as long as its event loop
+        self._connection = None
+
+    def set_retry_config(self, retry_config: dict):
+        super().set_retry_config(retry_config)
+        self._custom_retry = retry_config is not None
+
+    async def fetch(self):
+        """
+        Runs the query, retrying with a random exponential backoff unless it's a query error.
+
+        When a retry config was set (i.e: by the OPAL fetching engine), the tenacity based retry of OPAL is used instead.
+        """
+        if self._custom_retry:
+            return await super().fetch()
+
+        wait = self.RETRY_INITIAL_WAIT
+
+        for attempt in range(1, self.RETRY_ATTEMPTS + 1):
+            try:
+                return await self._fetch_()
+            except OperationFailure:
+                # query error (i.e: invalid pipeline stage, etc), retrying won't help
+                raise
+            except Exception:
+                if attempt == self.RETRY_ATTEMPTS:
+                    raise
+
+            await asyncio.sleep(random.uniform(0, wait))
+            wait = min(wait * 2, self.RETRY_MAX_WAIT)
 
     async def _fetch_(self):
         self._event: MongoDBFetchEvent # type casting
@@ -158,16 +373,16 @@ class MongoDBFetchProvider(BaseFetchProvider):
             )
             return []
 
+        handlers = {
+            "findOne": self._do_find_one,
+            "find": self._do_find,
+            "aggregate": self._do_aggregate,
+        }
+
         # validate that only one of findOne, find or aggregate is defined
-        defined_queries = 0
-        if self._event.config.findOne is not None:
-            defined_queries += 1
-        if self._event.config.find is not None:
-            defined_queries += 1
-        if self._event.config.aggregate is not None:
-            defined_queries += 1
-
-        if defined_queries != 1:
+        defined_queries = [kind for kind in handlers if getattr(self._event.config, kind) is not None]
+
+        if len(defined_queries) != 1:
             logger.warning(
                 "malformed fetcher config: MongoDB data entries requires one of findOne, find or aggregate to be defined!"
             )
@@ -182,137 +397,118 @@ class MongoDBFetchProvider(BaseFetchProvider):
         collection = db[self._event.config.collection]
 
         # define first option
-        if self._event.config.transform is not None:
-            first = self._event.config.transform.first
-            if first is None:
-                first = False
-        else:
-            first = False
-
-        if self._event.config.findOne is not None:
-            logger.debug(f"{self.__class__.__name__} executing findOne query")
-
-            try:
-                # read query, projection and options from config
-                query = self._event.config.findOne.query
-
-                if self._event.config.findOne.projection is not None:
-                    projection = self._event.config.findOne.projection
-                else:
-                    projection = None
-
-                if self._event.config.findOne.options is not None:
-                    options = self._event.config.findOne.options
-                else:
-                    options = {}
-
-                # fetch the data
-                document = await collection.find_one(
-                    query, projection=projection, **options
-                )
-
-                if document is None:
-                    return []
-                else:
-                    return [document]
-            except Exception as e:
-                template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-                message = template.format(type(e).__name__, e.args)
-
-                logger.error(f"{self.__class__.__name__} error executing findOne query")
-                logger.error(message)
-
-                # pass along the original exception
-                raise e
-
-        if self._event.config.find is not None:
-            logger.debug(f"{self.__class__.__name__} executing find query")
-
-            try:
-                # read query, projection and options from config
-                query = self._event.config.find.query
-
-                if self._event.config.find.projection is not None:
-                    projection = self._event.config.find.projection
-                else:
-                    projection = None
+        transform = self._event.config.transform
+        first = bool(transform and transform.first)
 
-                if self._event.config.find.options is not None:
-                    options = self._event.config.find.options
-                else:
-                    options = {}
-
-                # fetch the data
-                documents = []
-
-                cursor = collection.find(
-                    query, projection=projection, **options
-                )
+        handler = handlers[defined_queries[0]]
 
-                # if we only want the first document, we can just return it
-                if first:
-                    logger.debug(f"{self.__class__.__name__} fetching first document of find query")
-                    return await cursor.to_list(length=1)
+        ttl = self._event.config.cache_ttl
+        if ttl is None:
+            ttl = MONGODB_CACHE_TTL
 
-                # otherwise, we need to iterate over the cursor
-                logger.debug(f"{self.__class__.__name__} iterating documents of find query")
+        if ttl <= 0:
+            return await handler(collection, first)
 
-                async for document in cursor:
-                    documents.append(document)
+        # the same config against the same instance always fetches the same documents
+        key = (self._event.url, self._event.config.cache_key)
 
-                # return the documents
-                return documents
-            except Exception as e:
-                template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-                message = template.format(type(e).__name__, e.args)
+        # documents are cached encoded, so that every hit decodes its own copy that can be safely modified
+        cached = _RESULT_CACHE.get(key)
+        if cached is not None:
+            logger.debug(f"{self.__class__.__name__} using cached documents")
+            return bson.decode_all(cached[1])
 
-                logger.error(f"{self.__class__.__name__} error executing find query")
-                logger.error(message)
+        documents = await handler(collection, first)
 
-                # pass along the original exception
-                raise e
+        _RESULT_CACHE[key] = (ttl, b"".join(bson.encode(document) for document in documents))
 
-        if self._event.config.aggregate is not None:
-            logger.debug(f"{self.__class__.__name__} executing aggregation pipeline")
+        return documents
 
-            try:
-                # read pipeline and options from config
-                pipeline = self._event.config.aggregate.pipeline
+    def _keep_projection(self) -> Optional[dict]:
+        """
+        Builds the projection for the fields required by the transform, if any were specified.
+        """
+        transform = self._event.config.transform
+        if transform is None or transform.keepFields is None:
+            return None
 
-                if self._event.config.aggregate.options is not None:
-                    options = self._event.config.aggregate.options
-                else:
-                    options = {}
+        projection = {field: 1 for field in transform.keepFields}
+        if transform.mapKey is not None:
+            projection[transform.mapKey] = 1
 
-                # fetch the data
-                documents = []
+        return projection
 
-                cursor = collection.aggregate(
-                    pipeline, **options
-                )
+    @log_and_reraise("findOne query")
+    async def _do_find_one(self, collection: AsyncCollection, first: bool):
+        params = self._event.config.findOne
 
-                # if we only want the first document, we can just return it
-                if first:
-                    logger.debug(f"{self.__class__.__name__} fetching first document of aggregation pipeline")
-                    return await cursor.to_list(length=1)
-
-                # otherwise, we need to iterate over the cursor
-                logger.debug(f"{self.__class__.__name__} iterating documents of aggregation pipeline")
+        # fetch the data, together with other concurrent findOne on the same collection when possible
+        if (
+            MONGODB_COALESCE_WINDOW > 0
+            and params.projection is None
+            and not params.options
+            and FetchCoalescer.can_coalesce(params.query)
+        ):
+            document = await _COALESCER.find_one(collection, params.query)
+        else:
+            document = await collection.find_one(
+                params.query, projection=params.projection, **(params.options or {})
+            )
 
-                async for document in cursor:
-                    documents.append(document)
+        return [] if document is None else [document]
+
+    @log_and_reraise("find query")
+    async def _do_find(self, collection: AsyncCollection, first: bool):
+        params = self._event.config.find
+        options = params.options or {}
+
+        # an explicit projection wins over the one required by the transform
+        projection = params.projection
+        if projection is None:
+            projection = self._keep_projection()
+
+        # if we only want the first document, let the server stop after it and just return it
+        if first:
+            logger.debug(f"{self.__class__.__name__} fetching first document of find query")
+            return await collection.find(
+                params.query, projection=projection, **{**options, "limit": 1}
+            ).to_list(length=1)
+
+        # otherwise, we drain the cursor one batch at a time
+        logger.debug(f"{self.__class__.__name__} iterating documents of find query")
+
+        cursor = collection.find(
+            params.query, projection=projection, **options
+        )
+
+        return await cursor.to_list(length=None)
+
+    @log_and_reraise("aggregation pipeline")
+    async def _do_aggregate(self, collection: AsyncCollection, first: bool):
+        params = self._event.config.aggregate
+        pipeline = params.pipeline
+
+        # only send back the fields required by the transform
+        projection = self._keep_projection()
+        if projection is not None:
+            pipeline = pipeline + [{"$project": projection}]
+
+        # if we only want the first document, let the server stop after it and just return it
+        if first:
+            logger.debug(f"{self.__class__.__name__} fetching first document of aggregation pipeline")
+            cursor = await collection.aggregate(
+                pipeline + [{"$limit": 1}], **(params.options or {})
+            )
+            return await cursor.to_list(length=1)
 
-                # return the documents
-                return documents
-            except Exception as e:
-                template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-                message = template.format(type(e).__name__, e.args)
+        # otherwise, we drain the cursor one batch at a time
+        logger.debug(f"{self.__class__.__name__} iterating documents of aggregation pipeline")
 
-                logger.error(f"{self.__class__.__name__} error executing aggregation pipeline")
-                logger.error(message)
+        cursor = await collection.aggregate(
+            pipeline, **(params.options or {})
+        )
 
-                # pass along the original exception
-                raise e
+        return await cursor.to_list(length=None)
 
     async def _process_(self, records: List[dict]):
         self._event: MongoDBFetchEvent # type casting
@@ -323,35 +519,21 @@ class MongoDBFetchProvider(BaseFetchProvider):
             # handle findOne
             if self._event.config.findOne is not None:
                 if records and len(records) > 0 and records[0] is not None:
-                    return dict(records[0])
+                    return records[0]
                 else:
                     return {}
 
-            # define first option
-            if self._event.config.transform is not None:
-                first = self._event.config.transform.first
-                if first is None:
-                    first = False
-            else:
-                first = False
-
-            # define mapKey option
-            if self._event.config.transform is not None:
-                mapKey = self._event.config.transform.mapKey
-            else:
-                mapKey = None
-
-            # define merge option
-            if self._event.config.transform is not None:
-                merge = self._event.config.transform.merge
-                if merge is None:
-                    merge = False
+            # define first, mapKey and merge options
+            transform = self._event.config.transform
+            first = bool(transform and transform.first)
+            mapKey = transform.mapKey if transform else None
+            merge = bool(transform and transform.merge)
 
             # handle one single document
             result = None
             if first:
                 if records and len(records) > 0 and records[0] is not None:
-                    result = dict(records[0])
+                    result = records[0]
                 else:
                     result = {}
 
@@ -361,7 +543,7 @@ class MongoDBFetchProvider(BaseFetchProvider):
                 document = {}
 
                 for record in records:
-                    document.update(dict(record))
+                    document.update(record)
 
                 result = document
 
@@ -371,21 +553,17 @@ class MongoDBFetchProvider(BaseFetchProvider):
                 document = {}
 
                 for record in records:
-                    document[record[mapKey]] = dict(record)
+                    document[record[mapKey]] = record
 
                 result = document
 
             else:
-                # handle multiple documents
-                result = [dict(record) for record in records]
+                # handle multiple documents, pymongo already returns them as dicts
+                result = records
 
             return result
-        except Exception as e:
-            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(e).__name__, e.args)
-
-            logger.error(f"{self.__class__.__name__} error processing records")
-            logger.error(message)
+        except Exception:
+            logger.exception("{} error processing records", self.__class__.__name__)
 
             # pass along the original exception
-            raise e
+            raise